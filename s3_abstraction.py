@@ -1,18 +1,19 @@
 #!/usr/bin/env python3
 
-from collections import defaultdict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from utils import TempMessage, size_to_string, count_to_string, register_abstraction, chunks
+from utils import TempMessage, size_to_string, count_to_string, register_abstraction, chunks, batches
 from multiprocessing import Pool
 from urllib.parse import unquote, unquote_plus
 from aws_pager import aws_pager
 import csv
-import gzip
 import io
 import json
 import os
 import re
 import sys
+import threading
 if sys.version_info >= (3, 11): from datetime import UTC
 else: import datetime as datetime_fix; UTC=datetime_fix.timezone.utc
 try:
@@ -25,12 +26,43 @@ try:
     IMPORTS_OK = True
 except:
     IMPORTS_OK = False
+try:
+    # ISA-L is considerably faster at inflating the inventory files, but it's
+    # optional, so fall back to the normal gzip module if it's not available
+    from isal import igzip as _gz
+except ImportError:
+    import gzip as _gz
+try:
+    # pyarrow can decompress and parse the inventory files in native code, 
+    # it's optional, the csv module is used if it's not available
+    import pyarrow as pa
+    import pyarrow.compute as pa_compute
+    import pyarrow.csv as pa_csv
+    ARROW_OK = True
+except ImportError:
+    ARROW_OK = False
+try:
+    # numpy is used to calculate costs a batch at a time, it's optional
+    import numpy as np
+    NUMPY_OK = True
+except ImportError:
+    NUMPY_OK = False
 register_abstraction(__name__)
 
 MAIN_SWITCH = "--s3"
 FLAG_PREFIX = "s3_"
 DESCRIPTION = "Scan AWS S3 for object sizes"
 
+# How many S3 Inventory files to download at once
+INVENTORY_PREFETCH = 8
+
+# Inventory report "folders" end with the time the report was generated
+REPORT_FOLDER = re.compile("[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}-[0-9]{2}Z/$")
+
+# Clients created by get_client, keyed by service, profile, and options
+CLIENT_CACHE = {}
+CLIENT_LOCK = threading.Lock()
+
 def handle_args(opts, args):
     if not IMPORTS_OK:
         opts['show_help'] = True
@@ -112,6 +144,41 @@ def get_profiles(opts):
         temp['s3_profile'] = cur
         yield cur
 
+def get_client_config(service):
+    # Config shared by all clients, allow enough pooled connections that the
+    # threads calling into AWS aren't constantly reconnecting, this can be 
+    # tuned with the DIRSIZER_S3_POOL environment variable
+    pool_size = int(os.environ.get("DIRSIZER_S3_POOL", max(32, (os.cpu_count() or 1) * 4)))
+    config = Config(
+        max_pool_connections=pool_size,
+        retries={'max_attempts': 10, 'mode': 'adaptive'},
+        tcp_keepalive=True,
+    )
+    if service == 's3':
+        # The inventory files are gzip'd, which has its own CRC, so don't spend time
+        # validating S3's checksum of each file as well.  Older versions of botocore
+        # don't know about this option, but they don't validate by default either
+        try:
+            config = config.merge(Config(response_checksum_validation="when_required"))
+        except TypeError:
+            pass
+    return config
+
+def get_client(service, profile, signed=True, **args):
+    # Clients are thread safe, so create each one once and share it, the lock
+    # just prevents two threads from creating the same client at once
+    key = (service, profile, signed, args.get('endpoint_url'), args.get('region_name'))
+    with CLIENT_LOCK:
+        if key not in CLIENT_CACHE:
+            args['config'] = get_client_config(service)
+            if not signed:
+                args['config'] = args['config'].merge(Config(signature_version=UNSIGNED))
+            if len(profile):
+                CLIENT_CACHE[key] = boto3.Session(profile_name=profile).client(service, **args)
+            else:
+                CLIENT_CACHE[key] = boto3.client(service, **args)
+        return CLIENT_CACHE[key]
+
 def get_s3(opts, profile_name=None):
     args = {}
     if 's3_endpoint' in opts:
@@ -122,32 +189,111 @@ def get_s3(opts, profile_name=None):
     else:
         profile = profile_name
 
-    if "no-sign-request" in opts:
-        args['config'] = Config(signature_version=UNSIGNED)
-
-    if len(profile):
-        return boto3.Session(profile_name=profile).client('s3', **args)
-    else:
-        return boto3.client('s3', **args)
+    return get_client('s3', profile, signed="no-sign-request" not in opts, **args)
 
 def get_cw(profile, region):
-    if len(profile):
-        return boto3.Session(profile_name=profile).client('cloudwatch', region_name=region)
-    else:
-        return boto3.client('cloudwatch', region_name=region)
+    return get_client('cloudwatch', profile, region_name=region)
 
 def get_bucket_location(s3, bucket):
-    location = s3.get_bucket_location(Bucket=bucket)['LocationConstraint']
-    # us-east-1 and eu-west-1 are odd, they have weird values from this API, so map to the proper region
-    location = {None: 'us-east-1', 'EU': 'eu-west-1'}.get(location, location)
+    # HeadBucket returns the bucket's region in a header, even when the request is
+    # redirected or denied, so use that instead of GetBucketLocation when we can
+    try:
+        headers = s3.head_bucket(Bucket=bucket)['ResponseMetadata']['HTTPHeaders']
+    except botocore.exceptions.ClientError as ex:
+        headers = ex.response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    location = headers.get('x-amz-bucket-region')
+    if location is None:
+        # Not all S3 compatible services return the header, so fall back to asking directly
+        location = s3.get_bucket_location(Bucket=bucket)['LocationConstraint']
+        # us-east-1 and eu-west-1 are odd, they have weird values from this API, so map to the proper region
+        location = {None: 'us-east-1', 'EU': 'eu-west-1'}.get(location, location)
     return location
 
-def get_bucket_location_worker(job):
-    # Helper to handle lookup on a different process
-    opts, profile, bucket = job
-    s3 = get_s3(opts, profile)
-    location = get_bucket_location(s3, bucket)
-    return bucket, location
+def read_inventory_part(s3, inv_bucket, key):
+    # Helper to download one inventory CSV file on a background thread, the 
+    # whole file is read at once so the decoder can inflate it from memory
+    return s3.get_object(Bucket=inv_bucket, Key=key)['Body'].read()
+
+def get_literal_prefix(prefix):
+    # The keys in inventory files are URL encoded, so only the start of the prefix 
+    # that no encoder would escape can be compared before decoding, but that's 
+    # normally enough to throw away most rows without decoding them
+    return re.match("[A-Za-z0-9._-]*", prefix).group(0)
+
+def read_inventory_csv(data, schema, prefix):
+    # Parse a gzip'd inventory CSV file with the csv module, returning the
+    # raw key, size, and storage class for each object that might match prefix
+    literal = get_literal_prefix(prefix)
+    # Find the columns we care about once, rather than looking them up on each row
+    key_idx = schema.index('Key')
+    size_idx = schema.index('Size')
+    storage_idx = schema.index('StorageClass') if 'StorageClass' in schema else -1
+    with _gz.GzipFile(fileobj=io.BytesIO(data)) as gzf:
+        # Use a large buffer so the CSV reader isn't making many tiny reads
+        sr = io.TextIOWrapper(io.BufferedReader(gzf, buffer_size=1 << 20))
+        cr = csv.reader(sr)
+        for row in cr:
+            # Ignore Delete Markers and other objects that don't have a size,
+            # the caller checks the full prefix
+            if len(row[size_idx]) > 0 and row[key_idx].startswith(literal):
+                yield row[key_idx], int(row[size_idx]), (row[storage_idx] if storage_idx >= 0 else '')
+
+def read_inventory_arrow(data, schema, prefix):
+    # Parse a gzip'd inventory CSV file with pyarrow, returning the 
+    # raw key, size, and storage class for each object that might match prefix
+    types = {"Key": pa.string(), "Size": pa.int64(), "StorageClass": pa.string()}
+    types = {x: y for x, y in types.items() if x in schema}
+    try:
+        table = pa_csv.read_csv(
+            pa.input_stream(pa.py_buffer(data), compression="gzip"),
+            # We're already running one of these per core, so don't use more threads
+            read_options=pa_csv.ReadOptions(column_names=schema, use_threads=False),
+            convert_options=pa_csv.ConvertOptions(column_types=types, include_columns=list(types)),
+        )
+    except pa.ArrowInvalid as ex:
+        # An inventory file with no rows is valid, and the csv module treats it as
+        # such, but pyarrow refuses to parse it, so only pass along other errors
+        if "Empty CSV file" in str(ex):
+            return iter([])
+        raise
+    # Ignore Delete Markers and other objects that don't have a size, these
+    # show up as null values in the Size column
+    mask = pa_compute.is_valid(table["Size"])
+    # Throw away rows that can't match the prefix, the caller checks the full prefix
+    literal = get_literal_prefix(prefix)
+    if len(literal) > 0:
+        mask = pa_compute.and_(mask, pa_compute.starts_with(table["Key"], literal))
+    table = table.filter(mask)
+    keys = table["Key"].to_pylist()
+    sizes = table["Size"].to_pylist()
+    if "StorageClass" in types:
+        storage_classes = table["StorageClass"].to_pylist()
+    else:
+        storage_classes = [""] * len(keys)
+    return zip(keys, sizes, storage_classes)
+
+def decode_inventory_part_worker(job):
+    # Helper to decode one inventory CSV file on a different process,
+    # only the fields we need are sent back to keep the pickled results small
+    data, schema, prefix = job
+    prefix_len = len(prefix)
+    ret = []
+    reader = read_inventory_arrow if ARROW_OK else read_inventory_csv
+    for key, size, storage_class in reader(data, schema, prefix):
+        key = unquote(key)
+        if key.startswith(prefix):
+            ret.append((key[prefix_len:], size, storage_class))
+    return ret
+
+def get_metric_data_worker(job):
+    # Helper to call GetMetricData on a different thread
+    profile, region, queries, start_date = job
+    cw = get_cw(profile, region)
+    return cw.get_metric_data(
+        MetricDataQueries=queries,
+        StartTime=start_date,
+        EndTime=start_date + timedelta(days=1)
+    )
 
 def load_s3_cost_classes():
     # Load the pricing data, using this module's location as an anchor point
@@ -161,8 +307,50 @@ def load_pricing_data():
     with open(fn) as f:
         return json.load(f)
 
+def list_inventory_reports(s3, inv_bucket, inv_prefix, frequency):
+    # Return the manifest of each inventory report, newest first.  There can be 
+    # years of reports, so start by only listing the recent ones, and only list 
+    # all of them if none of the recent reports end up being used
+    days = 3 if frequency == "Daily" else 10
+    cutoff = (datetime.now(UTC) - timedelta(days=days)).strftime("%Y-%m-%dT00-00Z/")
+    seen = set()
+    for args in [{'StartAfter': inv_prefix + cutoff}, {}]:
+        reports = []
+        for _, cur in aws_pager(s3, 'list_objects_v2', 'CommonPrefixes', Bucket=inv_bucket, Prefix=inv_prefix, Delimiter="/", **args):
+            # Look for report "folders", ignoring the hive and data folders
+            if REPORT_FOLDER.search(cur['Prefix']) is not None:
+                if cur['Prefix'] not in seen:
+                    reports.append(cur['Prefix'])
+        reports.sort()
+        for report in reports[::-1]:
+            seen.add(report)
+            yield report + "manifest.json"
+
+def get_cost_table(costs):
+    # Turn a lookup of storage class to price per GiB into a lookup of storage 
+    # class to an index, along with the price per byte for each index
+    storage_classes = list(costs)
+    class_idx = {x: i for i, x in enumerate(storage_classes)}
+    per_byte = [costs[x] / 1073741824 for x in storage_classes]
+    if NUMPY_OK:
+        per_byte = np.array(per_byte, dtype=np.float64)
+    return class_idx, per_byte
+
+def get_batch_costs(sizes, storage_classes, cost_table):
+    # Return the cost of each object in a batch, and the total cost of the batch,
+    # this is (<size> / 1 GiB) * <price per GiB>
+    class_idx, per_byte = cost_table
+    if NUMPY_OK:
+        idx = np.fromiter(map(class_idx.__getitem__, storage_classes), dtype=np.intp, count=len(storage_classes))
+        costs = np.asarray(sizes, dtype=np.float64) * per_byte[idx]
+        return costs.tolist(), float(costs.sum())
+    else:
+        costs = [size * per_byte[class_idx[x]] for size, x in zip(sizes, storage_classes)]
+        return costs, sum(costs)
+
 def get_bucket_inventory(msg, s3, bucket, required_fields=set(), prefix=""):
-    # Load a S3 inventory report, including parsing CSV files
+    # Load a S3 inventory report, including parsing CSV files, returns the
+    # key (relative to prefix), size, and storage class of each object
     possible_configs = []
     config = None
 
@@ -223,16 +411,10 @@ def get_bucket_inventory(msg, s3, bucket, required_fields=set(), prefix=""):
     inv_prefix += bucket + "/"
     inv_prefix += config['Id'] + "/"
 
-    # List all of the reports
-    reports = []
-    for _, prefix in aws_pager(s3, 'list_objects_v2', 'CommonPrefixes', Bucket=inv_bucket, Prefix=inv_prefix, Delimiter="/"):
-        # Look for report "folders", ignoring the hive and data folders
-        if re.search("[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}-[0-9]{2}Z/$", prefix['Prefix']) is not None:
-            reports.append(prefix['Prefix'] + "manifest.json")
-
     found = False
     # Find the latest report we can get
-    for report in reports[::-1]:
+    frequency = config.get("Schedule", {}).get("Frequency", "")
+    for report in list_inventory_reports(s3, inv_bucket, inv_prefix, frequency):
         try:
             resp = s3.get_object(Bucket=inv_bucket, Key=report)
             found = True
@@ -252,18 +434,21 @@ def get_bucket_inventory(msg, s3, bucket, required_fields=set(), prefix=""):
 
         # Pull out the schema for these CSV files
         schema = [x.strip() for x in resp['fileSchema'].split(",")]
-        for file in resp['files']:
-            # And read through each row in this file
-            csv_gz = s3.get_object(Bucket=inv_bucket, Key=file['key'])['Body']
-            with gzip.GzipFile(fileobj=csv_gz) as gzf:
-                sr = io.TextIOWrapper(gzf)
-                cr = csv.reader(sr)
-                for row in cr:
-                    # Merge the schema and each row
-                    row = {x: y for x, y in zip(schema, row)}
-                    # Ignore Delete Markers and other objects that don't have a size
-                    if len(row['Size']) > 0:
-                        yield row
+        # Download the CSV files on a few threads, and decode each one on a different
+        # process, only letting a limited number of files be in flight at once so
+        # the downloads overlap the decoding without using too much memory
+        files = deque(x['key'] for x in resp['files'])
+        downloads, decodes = deque(), deque()
+        processes = os.cpu_count() or 1
+        with Pool(processes) as pool, ThreadPoolExecutor(max_workers=INVENTORY_PREFETCH) as ex:
+            while len(files) > 0 or len(downloads) > 0 or len(decodes) > 0:
+                while len(files) > 0 and len(downloads) < INVENTORY_PREFETCH:
+                    downloads.append(ex.submit(read_inventory_part, s3, inv_bucket, files.popleft()))
+                if len(downloads) > 0 and len(decodes) < processes:
+                    data = downloads.popleft().result()
+                    decodes.append(pool.apply_async(decode_inventory_part_worker, ((data, schema, prefix),)))
+                else:
+                    yield from decodes.popleft().get()
 
         # We're done with this report, don't move on to the next one
         break
@@ -273,7 +458,8 @@ def get_bucket_inventory(msg, s3, bucket, required_fields=set(), prefix=""):
 
 def s3_list_objects(msg, opts, s3):
     # Wrapper to call list_object_versions normally, or call into Inventory
-    # if that option is specified
+    # if that option is specified, returns the key (relative to the prefix), 
+    # size, and storage class of each object
 
     prefix_len = len(opts.get('s3_prefix', ''))
 
@@ -283,26 +469,18 @@ def s3_list_objects(msg, opts, s3):
         if opts.get('s3_cost', False):
             required_fields.add("StorageClass")
         prefix = opts.get('s3_prefix', '')
-        for row in get_bucket_inventory(msg, s3, opts['s3_bucket'], required_fields=required_fields, prefix=prefix):
-            key = unquote(row['Key'])
-            if key.startswith(prefix):
-                yield {
-                    'Key': key[prefix_len:],
-                    'Size': int(row['Size']),
-                    'StorageClass': row.get('StorageClass', ''),
-                }
+        yield from get_bucket_inventory(msg, s3, opts['s3_bucket'], required_fields=required_fields, prefix=prefix)
     else:
-        # Normal mode, just call list_object_versions and pass the results along
-        args = {"Bucket": opts['s3_bucket']}
+        # Normal mode, just call list_object_versions and pass the results along,
+        # asking for the largest page size the API allows
+        args = {"Bucket": opts['s3_bucket'], "MaxKeys": 1000}
         if 's3_prefix' in opts:
             args['Prefix'] = opts['s3_prefix']
 
+        # The storage class is only needed to find the cost
+        cost = opts.get('s3_cost', False)
         for _, cur in aws_pager(s3, 'list_object_versions', 'Versions', **args):
-            yield {
-                'Key': cur['Key'][prefix_len:],
-                'Size': cur['Size'],
-                'StorageClass': cur['StorageClass'],
-            }
+            yield cur['Key'][prefix_len:], cur['Size'], (cur['StorageClass'] if cost else '')
 
 def scan_folder(opts):
     msg = TempMessage()
@@ -320,61 +498,63 @@ def scan_folder(opts):
                 raise Exception(f"Unknown costs for region {location}!")
             # Lookup table to look up a S3 Storage Class to price per GiB
             costs = {x['s3']: float(temp[location][x['desc']]) for x in load_s3_cost_classes()}
+            cost_table = get_cost_table(costs)
         else:
-            location = None
-            costs = None
+            cost_table = None
 
-        for i, cur in enumerate(s3_list_objects(msg, opts, s3)):
-            if location is None:
-                size = cur['Size']
-            else:
+        # Work in batches so the costs can be calculated for many objects at once
+        for batch in batches(s3_list_objects(msg, opts, s3), 10000):
+            keys, sizes, storage_classes = zip(*batch)
+            if cost_table is not None:
                 # We're in s3_cost mode, so use the cost as the size
-                # This is (<size> / 1 GiB) * <price per GiB>
-                size = (cur['Size'] / 1073741824) * costs[cur['StorageClass']]
-            total_objects += 1
-            total_size += size
-            yield cur['Key'].split("/"), size
-            if i % 1000 == 999:
-                msg(f"Scanning, gathered {total_objects} totaling {dump_size(opts, total_size)}...")
+                sizes, batch_size = get_batch_costs(sizes, storage_classes, cost_table)
+            else:
+                batch_size = sum(sizes)
+            total_objects += len(batch)
+            total_size += batch_size
+            for key, size in zip(keys, sizes):
+                yield key.split("/"), size
+            msg(f"Scanning, gathered {total_objects} totaling {dump_size(opts, total_size)}...")
     else:
         # List all the buckets, break out by region
-        buckets = defaultdict(lambda: defaultdict(list))
+        buckets = {}
         seen_buckets = 0
         for profile in get_profiles(opts):
             s3 = get_s3(opts, profile)
-            with Pool() as pool:
-                temp = {x: y for x, y in opts.items() if x.startswith("s3_")}
-                for bucket, location in pool.imap_unordered(get_bucket_location_worker, [(temp, profile, x['Name']) for x in s3.list_buckets()['Buckets']]):
+            # The lookups are just network calls, so use threads sharing one client
+            with ThreadPoolExecutor(max_workers=32) as ex:
+                futures = {ex.submit(get_bucket_location, s3, x['Name']): x['Name'] for x in s3.list_buckets()['Buckets']}
+                for future in as_completed(futures):
+                    bucket, location = futures[future], future.result()
                     seen_buckets += 1
                     msg(f"Scanning, finding buckets, gathered data for {seen_buckets} buckets...")
-                    buckets[profile][location].append(bucket)
+                    buckets.setdefault(profile, {}).setdefault(location, []).append(bucket)
 
         # The range to query from CloudWatch, basically, get the latest metric for each bucket, 
         # with some padding to handle the daily roll off of data
         now = datetime.now(UTC).replace(tzinfo=None)
         now = datetime(now.year, now.month, now.day)
         start_date = now - timedelta(hours=36)
-        stats = defaultdict(lambda: defaultdict(dict))
+        stats = {}
         bucket_to_region = {}
 
+        # Pull out all of the possible cost classes
+        storages = [(x['cw'], 'BucketSizeBytes', True) for x in load_s3_cost_classes()]
+        # And ask for the number of objects in each bucket as well
+        storages.append(('AllStorageTypes', 'NumberOfObjects', False))
+
+        # Build up the queries for each region of each profile
+        queries = {}
         for profile in buckets:
             for region in buckets[profile]:
-                queries = []
-                bucket_ids = {}
-                cw = get_cw(profile, region)
-
-                # Pull out all of the possible cost classes
-                storages = [(x['cw'], 'BucketSizeBytes', True) for x in load_s3_cost_classes()]
-                # And ask for the number of objects in each bucket as well
-                storages.append(('AllStorageTypes', 'NumberOfObjects', False))
-
+                queries[(profile, region)] = []
                 # For each bucket in this region, add a request for each metric we want to track
-                for bucket in buckets[profile][region]:
+                # The Id of each query is the index of the bucket and storage to make it easy to find later
+                for bucket_idx, bucket in enumerate(buckets[profile][region]):
                     bucket_to_region[bucket] = region
-                    bucket_ids[bucket] = "%02d" % (len(bucket_ids),)
-                    for storage, metric_name, _cost in storages:
-                        queries.append({
-                                'Id': 'i' + bucket_ids[bucket] + storage,
+                    for storage_idx, (storage, metric_name, _cost) in enumerate(storages):
+                        queries[(profile, region)].append({
+                                'Id': f"i{bucket_idx}_{storage_idx}",
                                 'MetricStat': {
                                     'Metric': {
                                         'Namespace': 'AWS/S3',
@@ -389,34 +569,45 @@ def scan_folder(opts):
                                 }
                             })
 
-                # A place to store the metrics we'll gather up
-                final_metrics = {}
-                
-                # Call into cloudwatch as few times as possible
-                for chunk_page, queries_chunk in enumerate(chunks(queries, 100)):
-                    msg(f"Scanning, got {len(queries_chunk)} stats for {region}, on page {chunk_page+1}, done with {len(stats)} buckets...")
-                    metrics = cw.get_metric_data(
-                        MetricDataQueries=queries_chunk,
-                        StartTime=start_date,
-                        EndTime=start_date + timedelta(days=1)
-                    )
-                    # The metrics are returned in a list, turn it into a dictionary to make things easier
-                    for cur in metrics['MetricDataResults']:
-                        final_metrics[cur['Id']] = cur
+        # Call into cloudwatch as few times as possible, GetMetricData allows up to 500 queries per call,
+        # and the calls are just network calls to different endpoints, so make them all at once on threads
+        jobs = []
+        for (profile, region), temp in queries.items():
+            for queries_chunk in chunks(temp, 500):
+                jobs.append((profile, region, queries_chunk, start_date))
+        metrics = {}
+        with ThreadPoolExecutor(max_workers=16) as ex:
+            for i, ((profile, region, _queries_chunk, _start_date), resp) in enumerate(zip(jobs, ex.map(get_metric_data_worker, jobs))):
+                msg(f"Scanning, got stats for {region}, done with {i+1} of {len(jobs)} pages...")
+                metrics.setdefault((profile, region), []).append(resp)
+
+        # The days for each timestamp, the timestamps are the same for most metrics, so only format each one once
+        days = {}
+        temp_cur = start_date.strftime("%Y-%m-%d")
+        for profile in buckets:
+            for region in buckets[profile]:
+                # A place to store the metrics we'll gather up, by bucket and storage index
+                final_metrics = [[None] * len(storages) for _ in buckets[profile][region]]
+
+                for resp in metrics[(profile, region)]:
+                    # The metrics are returned in a list, store each one by its indexes to make things easier,
+                    # with each metric turned into a lookup of day to value, keeping the first value for each day
+                    for cur in resp['MetricDataResults']:
+                        by_day = {}
+                        for timestamp, value in zip(cur['Timestamps'], cur['Values']):
+                            if timestamp not in days:
+                                days[timestamp] = timestamp.strftime("%Y-%m-%d")
+                            by_day.setdefault(days[timestamp], value)
+                        bucket_idx, storage_idx = cur['Id'][1:].split("_")
+                        final_metrics[int(bucket_idx)][int(storage_idx)] = by_day
 
                 # And for each bucket, pull out the metrics into our final stats object
-                for bucket in buckets[profile][region]:
-                    temp_cur = start_date.strftime("%Y-%m-%d")
-                    for storage, _metric_name, _cost in storages:
-                        temp_metrics = final_metrics['i' + bucket_ids[bucket] + storage]
+                for bucket_idx, bucket in enumerate(buckets[profile][region]):
+                    for storage_idx, (storage, _metric_name, _cost) in enumerate(storages):
                         # Find the metric for the current day, treat lack of a value as 0
-                        value = 0.0
-                        for i in range(len(temp_metrics['Timestamps'])):
-                            if temp_metrics['Timestamps'][i].strftime("%Y-%m-%d") == temp_cur:
-                                value = temp_metrics['Values'][i]
-                                break
+                        value = final_metrics[bucket_idx][storage_idx].get(temp_cur, 0.0)
                         # All of the values we want are really integers, so treat them as such
-                        stats[bucket][storage] = int(value)
+                        stats.setdefault(bucket, {})[storage] = int(value)
 
             # Load cost data if we want to use it
             if opts.get('s3_cost', False):
@@ -2,6 +2,7 @@
 
 from datetime import datetime, timedelta
 from collections import defaultdict
+from itertools import islice
 import json
 import sys
 if sys.version_info >= (3, 11): from datetime import UTC
@@ -141,5 +142,14 @@ def chunks(values, size):
     for i in range(0, len(values), size):
         yield values[i : i + size]
 
+def batches(values, size):
+    # Like chunks, but works with any iterable, returning lists
+    values = iter(values)
+    while True:
+        batch = list(islice(values, size))
+        if len(batch) == 0:
+            break
+        yield batch
+
 if __name__ == "__main__":
     print("This module is not meant to be run directly")